@@ -1,7 +1,23 @@
 #!/usr/bin/env python3
 from copy import deepcopy
-from pathlib import Path
-import sys, shutil, json, subprocess, re, os
+from pathlib import Path, PurePosixPath
+from array import array
+from itertools import chain
+from contextlib import redirect_stdout
+from threading import Condition, Lock, Thread
+from tempfile import mkstemp
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+from typing import Callable, Iterable, Iterator, NamedTuple, Optional
+import sys, shutil, json, subprocess, re, os, mmap, argparse, errno, struct, multiprocessing, queue, tarfile, fnmatch
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from time import time
 from hashlib import sha1
 
@@ -87,97 +103,1337 @@ class LiteDB:
         proc.wait()
 
 
-input_romfs_path = Path(sys.argv[1])  # romfs
+# Ways to copy an entry out of a pack, each one falls back to the next
+copy_backends = ['copy_file_range', 'sendfile', 'mmap']
+
+
+def default_copy_backend() -> str:
+    # Kernel-side copies on Linux, plain writes from the mapped pack elsewhere
+    if sys.platform.startswith('linux'):
+        for backend in copy_backends[:-1]:
+            if hasattr(os, backend):
+                return backend
+    return 'mmap'
+
+
+class IOPolicy(NamedTuple):
+    # How reads and writes use the page cache, all of it is advice the kernel may ignore
+    sequential: bool = True  # Readahead hints for inputs read from start to end
+    prefetch: bool = False  # Start reading a whole planned range of a pack right away
+    drop_consumed: bool = False  # Evict input pages from the page cache once they have been consumed
+    preallocate_outputs: bool = False  # Allocate outputs of known size in one go before writing them
+
+    def advise_input(self, fd: int, offset: int = 0, length: int = 0):
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        if self.sequential:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_SEQUENTIAL)
+        if self.prefetch:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+
+    def consumed(self, fd: int, offset: int = 0, length: int = 0):
+        if self.drop_consumed and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+    def preallocate(self, fd: int, size: int):
+        if not self.preallocate_outputs or size <= 0 or not hasattr(os, 'posix_fallocate'):
+            return
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            if e.errno not in {errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOSYS}:
+                raise
+
+
+io_policies = {
+    # Sequential hints only, whatever is read or written stays cached as long as the kernel likes
+    'default': IOPolicy(),
+    # Keep the page cache footprint of a run small, for hosts shared with other work
+    'streaming': IOPolicy(drop_consumed=True, preallocate_outputs=True),
+    # Read packs ahead as far as possible and keep everything cached, for a machine of our own
+    'aggressive': IOPolicy(prefetch=True, preallocate_outputs=True),
+}
+
+
+class CopyOptions(NamedTuple):
+    backend: str = 'mmap'
+    chunk_size: int = 8 << 20
+    pipeline_writers: int = 0  # Writer threads of the read-ahead pipeline, 0 to copy entries in place
+    pipeline_depth: int = 4  # Chunk buffers the pipeline reader may fill ahead of the writers
+    io_policy: str = 'default'  # Key of io_policies
+
+
+class MemoryBudget:
+    # Bytes of entry data that all extraction workers together may hold in memory at once.
+    # A shared budget is backed by multiprocessing primitives so that it can be handed to worker processes,
+    # those need POSIX semaphores, so threads of a single process get plain threading ones.
+    def __init__(self, limit: int, shared: bool = False):
+        self.limit = limit
+        if shared:
+            self.condition = multiprocessing.Condition()
+            self.used = multiprocessing.RawArray('q', 1)
+        else:
+            self.condition = Condition()
+            self.used = array('q', [0])
+
+    def acquire(self, size: int) -> int:
+        # A request larger than the whole budget still gets through once nothing else is held
+        size = min(size, self.limit)
+        with self.condition:
+            while self.used[0] > 0 and self.used[0] + size > self.limit:
+                self.condition.wait()
+            self.used[0] += size
+        return size
+
+    def release(self, size: int):
+        with self.condition:
+            self.used[0] -= size
+            self.condition.notify_all()
+
+
+# Budget of this process, set by main() and by the initializer of extraction worker processes
+memory_budget: Optional[MemoryBudget] = None
+
+
+def set_memory_budget(budget: Optional[MemoryBudget]):
+    global memory_budget
+    memory_budget = budget
+
+
+class PackReader:
+    # Read-only mmap view of a .pack file, entries are handed out as zero-copy memoryviews
+    # Errors after which the kernel-side copy is given up and the next backend is tried
+    fallback_errors = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EPERM}
+
+    def __init__(self, path: Path, options: CopyOptions = CopyOptions()):
+        self.path = path
+        self.backend = options.backend
+        self.chunk_size = max(options.chunk_size, mmap.PAGESIZE)
+        self.io_policy = io_policies[options.io_policy]
+        self.file = open(path, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size > 0:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)
+        else:  # mmap refuses to map empty files
+            self.map = None
+            self.view = memoryview(b'')
+
+    def check(self, offset: int, length: int):
+        if offset < 0 or length < 0 or offset + length > self.size:
+            raise ValueError(f'Entry {offset}+{length} out of bounds of {self.path.name} ({self.size} bytes)')
+
+    def advise_sequential(self, offset: int, length: int):
+        # Readahead hints for a forward sweep over offset..offset+length
+        self.io_policy.advise_input(self.file.fileno(), offset, length)
+        if self.io_policy.sequential and self.map is not None and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+
+    def entry(self, offset: int, length: int) -> memoryview:
+        self.check(offset, length)
+        return self.view[offset:offset + length]
+
+    def read_into(self, buffer: memoryview, offset: int):
+        # Fill buffer with the pack bytes at offset, through the file rather than the mapping
+        self.check(offset, len(buffer))
+        filled = 0
+        while filled < len(buffer):
+            if hasattr(os, 'preadv'):
+                count = os.preadv(self.file.fileno(), [buffer[filled:]], offset + filled)
+            else:
+                self.file.seek(offset + filled)
+                count = self.file.readinto(buffer[filled:])
+            if not count:
+                raise EOFError(f'Unexpected end of {self.path.name} at {offset + filled}')
+            filled += count
+        self.release_pages(offset, len(buffer))
+
+    def release_pages(self, offset: int, length: int):
+        # Drop mapped pages that have been consumed, they leave our RSS,
+        # and the page cache as well if the I/O policy says so
+        self.io_policy.consumed(self.file.fileno(), offset, length)
+        if self.map is None or not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        start = offset - offset % mmap.PAGESIZE
+        end = min(offset + length, self.size)
+        if end > start:
+            self.map.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def hash_range(self, digest, offset: int, length: int):
+        with self.entry(offset, length) as data:
+            digest.update(data)
+        self.release_pages(offset, length)
+
+    def copy_to(self, out_f, offset: int, length: int, digest=None):
+        # Copy an entry to the current position of out_f in chunks of at most chunk_size,
+        # in the kernel when the backend allows it. The copied bytes are fed to digest if given,
+        # for kernel-side copies they are hashed from the mapping right after each chunk.
+        self.check(offset, length)
+        done = 0
+        while self.backend != 'mmap' and done < length:
+            count = min(self.chunk_size, length - done)
+            try:
+                if self.backend == 'copy_file_range':
+                    copied = os.copy_file_range(self.file.fileno(), out_f.fileno(), count, offset + done)
+                else:
+                    copied = os.sendfile(out_f.fileno(), self.file.fileno(), offset + done, count)
+            except OSError as e:
+                if e.errno not in self.fallback_errors:
+                    raise
+                copied = 0
+            if copied == 0:
+                self.backend = copy_backends[copy_backends.index(self.backend) + 1]
+            elif digest is not None:
+                self.hash_range(digest, offset + done, copied)
+            else:
+                self.release_pages(offset + done, copied)
+            done += copied
+        while done < length:
+            count = min(self.chunk_size, length - done)
+            held = memory_budget.acquire(count) if memory_budget is not None else 0
+            try:
+                with self.entry(offset + done, count) as data:
+                    out_f.write(data)
+                    if digest is not None:
+                        digest.update(data)
+                self.release_pages(offset + done, count)
+            finally:
+                if memory_budget is not None:
+                    memory_budget.release(held)
+            done += count
+
+    def close(self):
+        self.view.release()
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
 extracted_romfs_path = Path('./extracted_romfs')
-arc_create_db_input_path = Path(sys.argv[2])  # arccreate.litedb
 final_path = Path('./final')
+index_cache_path = Path('./index_cache')
 
-msg.ask('Preparing ...')
 
-# Check for required files
-if not litedb_path.exists():
-    msg.error('ArcUnpack.LiteDB not found!')
-    sys.exit(1)
+class EntryView:
+    # One row of an EntryTable
+    __slots__ = ('table', 'row')
 
-if not input_romfs_path.exists():
-    if extracted_romfs_path.exists():
-        msg.warning('Extracted romfs found, skipping extraction...')
-    else:
-        msg.error('Input romfs not found!')
-        sys.exit(1)
+    def __init__(self, table: 'EntryTable', row: int):
+        self.table = table
+        self.row = row
 
-# Make folders
-extracted_romfs_path.mkdir(parents=True, exist_ok=True)
-final_path.mkdir(parents=True, exist_ok=True)
+    @property
+    def offset(self) -> int:
+        return self.table.offsets[self.row]
 
-# Copy database file
-arc_create_db_path = final_path / 'arccreate.litedb'
-if not arc_create_db_path.exists():
-    shutil.copy(arc_create_db_input_path, arc_create_db_path)
+    @property
+    def length(self) -> int:
+        return self.table.lengths[self.row]
 
-# LiteDB instance
-litedb = LiteDB(arc_create_db_path)
+    @property
+    def group(self) -> str:
+        return self.table.groups[self.table.group_ids[self.row]]
 
-# File list to extract
-pack_list: list[Path] = []
-for pack in input_romfs_path.glob('*.pack'):
-    pack_list.append(pack)
-pack_list.sort()
+    @property
+    def filename(self) -> str:
+        return self.table.filenames[self.table.path_ids[self.row]]
 
-msg.ask('Extracting romfs...')
+    @property
+    def path(self) -> str:
+        return self.table.path(self.row)
 
-# Extract romfs
-for pack_path in pack_list:
-    with open(pack_path, 'rb') as pack:
-        msg.msg(f'Extracting pack {pack_path.name}...')
-        index_file = pack_path.with_suffix('.json')
-        with open(index_file) as index_f:
-            index: dict = json.load(index_f)
-            for group in index['Groups']:
-                msg.msg2(f'Extracting group {group["Name"]}...')
-                group_path = extracted_romfs_path / group['Name']
-                group_path.mkdir(parents=True, exist_ok=True)
-
-                for ordered_entry in group['OrderedEntries']:
-                    file_path = group_path / ordered_entry['OriginalFilename']
-                    file_path.parent.mkdir(parents=True, exist_ok=True)
-                    pack.seek(ordered_entry['Offset'])
-                    with open(file_path, 'wb') as out_f:
-                        out_f.write(pack.read(ordered_entry['Length']))
+    def __repr__(self):
+        return f'EntryView({self.path!r}, offset={self.offset}, length={self.length})'
+
+
+class EntryTable:
+    # Entries of a pack index as columns, in index order: Offset and Length arrays,
+    # plus ids into the group names and the interned OriginalFilename strings
+    def __init__(
+            self,
+            groups: list[str],
+            filenames: list[str],
+            offsets: array,
+            lengths: array,
+            group_ids: array,
+            path_ids: array
+    ):
+        self.groups = groups
+        self.filenames = filenames
+        self.offsets = offsets
+        self.lengths = lengths
+        self.group_ids = group_ids
+        self.path_ids = path_ids
+        self.sorted_rows: Optional[array] = None
+
+    @classmethod
+    def from_index(cls, index: dict) -> 'EntryTable':
+        table = cls([], [], array('Q'), array('Q'), array('I'), array('I'))
+        interned: dict[str, int] = {}
+        for group_id, group in enumerate(index['Groups']):
+            table.groups.append(group['Name'])
+            for ordered_entry in group['OrderedEntries']:
+                filename = ordered_entry['OriginalFilename']
+                if filename not in interned:
+                    interned[filename] = len(table.filenames)
+                    table.filenames.append(filename)
+                table.offsets.append(ordered_entry['Offset'])
+                table.lengths.append(ordered_entry['Length'])
+                table.group_ids.append(group_id)
+                table.path_ids.append(interned[filename])
+        return table
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, row: int) -> EntryView:
+        return EntryView(self, row)
+
+    def __iter__(self):
+        return (EntryView(self, row) for row in range(len(self)))
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, EntryTable) and all(
+            getattr(self, name) == getattr(other, name)
+            for name in ('groups', 'filenames', 'offsets', 'lengths', 'group_ids', 'path_ids')
+        )
+
+    def path(self, row: int) -> str:
+        # Path of an entry relative to the extracted romfs root
+        return f'{self.groups[self.group_ids[row]]}/{self.filenames[self.path_ids[row]]}'
+
+    def by_offset(self) -> list[int]:
+        return sorted(range(len(self)), key=self.offsets.__getitem__)
+
+    def find(self, path: str) -> Optional[int]:
+        # Row of the entry at path, the last one if the index lists it twice.
+        # Rows are sorted by path once, so a lookup only builds the paths it bisects over.
+        if self.sorted_rows is None:
+            self.sorted_rows = array('I', sorted(range(len(self)), key=self.path))
+        low, high = 0, len(self.sorted_rows)
+        while low < high:
+            middle = (low + high) // 2
+            if path < self.path(self.sorted_rows[middle]):
+                high = middle
+            else:
+                low = middle + 1
+        if low and self.path(self.sorted_rows[low - 1]) == path:
+            return self.sorted_rows[low - 1]
+        return None
+
+
+# Compiled index: header, then the Offset, Length, group id and path id columns of an EntryTable
+# in native byte order, then the group names and filenames as a NUL-separated string table
+index_cache_magic = b'AUIX'
+index_cache_version = 2
+index_cache_header = struct.Struct('<4sIIIIQ')
+
+
+def write_index_cache(cache_file: Path, table: EntryTable):
+    strings = '\0'.join([*table.groups, *table.filenames]).encode('utf-8')
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = cache_file.with_name(f'{cache_file.name}.{os.getpid()}.tmp')
+    with open(temp_file, 'wb') as cache_f:
+        cache_f.write(index_cache_header.pack(
+            index_cache_magic, index_cache_version,
+            len(table.groups), len(table.filenames), len(table), len(strings)
+        ))
+        for column in (table.offsets, table.lengths, table.group_ids, table.path_ids):
+            column.tofile(cache_f)
+        cache_f.write(strings)
+    os.replace(temp_file, cache_file)
+
+
+def read_index_cache(cache_file: Path) -> Optional[EntryTable]:
+    with open(cache_file, 'rb') as cache_f, mmap.mmap(cache_f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        magic, version, group_count, filename_count, entry_count, strings_size = index_cache_header.unpack_from(data)
+        if magic != index_cache_magic or version != index_cache_version:
+            return None
+        columns = [array('Q'), array('Q'), array('I'), array('I')]
+        position = index_cache_header.size
+        for column in columns:
+            end = position + entry_count * column.itemsize
+            column.frombytes(data[position:end])
+            position = end
+        if len(data) != position + strings_size:
+            return None
+        strings = data[position:].decode('utf-8').split('\0') if group_count + filename_count else []
+    return EntryTable(strings[:group_count], strings[group_count:], *columns)
+
+
+def load_pack_index(index_file: Path, cache_path: Optional[Path] = index_cache_path) -> EntryTable:
+    # Parse a pack's .json index, or load its compiled form from the cache keyed by the hash of the .json
+    with open(index_file, 'rb') as index_f:
+        index_data = index_f.read()
+    if cache_path is None:
+        return EntryTable.from_index(json.loads(index_data))
+    cache_file = cache_path / f'{sha1(index_data).hexdigest()}.bin'
+    if cache_file.exists():
+        try:
+            table = read_index_cache(cache_file)
+        except (ValueError, struct.error, UnicodeDecodeError):
+            table = None
+        if table is not None:
+            return table
+    table = EntryTable.from_index(json.loads(index_data))
+    write_index_cache(cache_file, table)
+    return table
+
+
+class IndexProblems(NamedTuple):
+    out_of_bounds: list[int]  # Rows reaching past the end of the pack
+    overlaps: list[tuple[int, int]]  # (row, earlier row it overlaps) for partial overlaps
+    duplicates: list[int]  # Rows whose path already appeared earlier in the index
+    empty: list[int]  # Rows of zero Length
+    aliases: int  # Rows sharing Offset and Length with an earlier one, these are expected
+    gap_bytes: int  # Bytes of the pack no entry covers
+
+
+def check_pack_index_numpy(table: EntryTable, pack_size: int) -> IndexProblems:
+    offsets = numpy.frombuffer(table.offsets, dtype=numpy.uint64).astype(numpy.int64)
+    lengths = numpy.frombuffer(table.lengths, dtype=numpy.uint64).astype(numpy.int64)
+    ends = offsets + lengths
+    rows = numpy.arange(len(table))
+
+    order = numpy.lexsort((lengths, offsets))
+    sorted_offsets, sorted_ends = offsets[order], ends[order]
+    # Furthest end among all entries before each one in offset order, and the row it belongs to
+    furthest = numpy.maximum.accumulate(sorted_ends)
+    new_furthest = numpy.concatenate(([True], sorted_ends[1:] > furthest[:-1]))
+    furthest_rows = order[numpy.maximum.accumulate(numpy.where(new_furthest, numpy.arange(len(order)), 0))]
+    alias = (sorted_offsets[1:] == sorted_offsets[:-1]) & (sorted_ends[1:] == sorted_ends[:-1])
+    overlap = (sorted_offsets[1:] < furthest[:-1]) & ~alias & (sorted_ends[1:] > sorted_offsets[1:])
+    covered_starts = numpy.concatenate(([0], furthest[:-1])) if len(order) else numpy.zeros(0, numpy.int64)
+    gap_bytes = int(numpy.clip(sorted_offsets - covered_starts, 0, None).sum())
+    gap_bytes += max(pack_size - int(furthest[-1]), 0) if len(order) else pack_size
+
+    keys = (numpy.frombuffer(table.group_ids, dtype=numpy.uint32).astype(numpy.uint64) << numpy.uint64(32)) \
+        | numpy.frombuffer(table.path_ids, dtype=numpy.uint32).astype(numpy.uint64)
+    first_rows = numpy.unique(keys, return_index=True)[1]
+    duplicate = numpy.ones(len(table), dtype=bool)
+    duplicate[first_rows] = False
+
+    return IndexProblems(
+        rows[ends > pack_size].tolist(),
+        sorted(zip(order[1:][overlap].tolist(), furthest_rows[:-1][overlap].tolist())),
+        rows[duplicate].tolist(),
+        rows[lengths == 0].tolist(),
+        int(alias.sum()),
+        gap_bytes
+    )
+
+
+def check_pack_index_python(table: EntryTable, pack_size: int) -> IndexProblems:
+    offsets, lengths = table.offsets, table.lengths
+    problems = IndexProblems([], [], [], [], 0, 0)
+    aliases, gap_bytes = 0, 0
+    seen: set[tuple[int, int]] = set()
+    furthest, furthest_row, previous = 0, -1, None
+    for row in sorted(range(len(table)), key=lambda r: (offsets[r], lengths[r])):
+        offset, end = offsets[row], offsets[row] + lengths[row]
+        if end > pack_size:
+            problems.out_of_bounds.append(row)
+        if lengths[row] == 0:
+            problems.empty.append(row)
+        if previous is not None and (offsets[previous], lengths[previous]) == (offset, lengths[row]):
+            aliases += 1
+        elif offset < furthest and end > offset:
+            problems.overlaps.append((row, furthest_row))
+        gap_bytes += max(offset - furthest, 0)
+        if end > furthest:
+            furthest, furthest_row = end, row
+        previous = row
+    for row in range(len(table)):
+        key = (table.group_ids[row], table.path_ids[row])
+        if key in seen:
+            problems.duplicates.append(row)
+        seen.add(key)
+    for rows in (problems.out_of_bounds, problems.overlaps, problems.empty):
+        rows.sort()
+    return problems._replace(aliases=aliases, gap_bytes=gap_bytes + max(pack_size - furthest, 0))
+
+
+def check_pack_index(table: EntryTable, pack_size: int) -> IndexProblems:
+    # Bounds, overlaps, duplicate paths and gaps of a pack index, in one vectorised pass when NumPy is available
+    if numpy is not None:
+        return check_pack_index_numpy(table, pack_size)
+    return check_pack_index_python(table, pack_size)
+
+
+def partition_plan(table: EntryTable, plan: list[int], parts: int) -> list[list[int]]:
+    # Cut an offset-ordered plan of rows into at most `parts` contiguous runs of roughly equal total Length
+    lengths = table.lengths
+    total = sum(lengths[row] for row in plan)
+    runs: list[list[int]] = []
+    start = 0
+    done = 0
+    for i, row in enumerate(plan):
+        done += lengths[row]
+        if len(runs) < parts - 1 and done * parts >= total * (len(runs) + 1):
+            runs.append(plan[start:i + 1])
+            start = i + 1
+    if start < len(plan):
+        runs.append(plan[start:])
+    return runs
+
+
+def make_directories(paths: Iterable[Path]):
+    # Create each distinct directory once, parents first, instead of a mkdir(parents=True) per file
+    directories: set[Path] = set()
+    for path in paths:
+        while path not in directories and path != path.parent:
+            directories.add(path)
+            path = path.parent
+    for directory in sorted(directories, key=lambda d: len(d.parts)):
+        try:
+            directory.mkdir()
+        except FileExistsError:
+            pass
+
+
+# ioctl of Linux to share the extents of one file with another on CoW filesystems (btrfs, XFS)
+FICLONE = 0x40049409
+link_methods = ['reflink', 'hardlink', 'copy']
+
+
+def link_file(source: Path, destination: Path) -> Optional[str]:
+    # Make destination share the content of source without copying it, returns the way it was done,
+    # None if the filesystem allows neither. An existing destination is replaced, never written through.
+    destination.unlink(missing_ok=True)
+    if fcntl is not None and sys.platform.startswith('linux'):
+        with open(source, 'rb') as source_f, open(destination, 'wb') as destination_f:
+            try:
+                fcntl.ioctl(destination_f.fileno(), FICLONE, source_f.fileno())
+                return 'reflink'
+            except OSError:
+                pass
+        destination.unlink(missing_ok=True)
+    try:
+        os.link(source, destination)
+        return 'hardlink'
+    except OSError:
+        return None
+
+
+def link_or_copy(source: Path, destination: Path) -> str:
+    # Make destination a file with the content of source as cheaply as the filesystem allows,
+    # returns the way it was done
+    method = link_file(source, destination)
+    if method is None:
+        shutil.copyfile(source, destination)
+        method = 'copy'
+    return method
+
+
+def open_output(path: Path):
+    # Outputs are replaced rather than truncated, the old file may be a hardlink of another output
+    path.unlink(missing_ok=True)
+    return open(path, 'wb')
+
+
+class Manifest:
+    # What was extracted from which pack, so that entries still up to date are skipped on the next run
+    def __init__(self, path: Path):
+        self.path = path
+        self.packs: dict[str, dict] = {}
+        if path.exists():
+            try:
+                with open(path) as manifest_f:
+                    self.packs = json.load(manifest_f)['packs']
+            except (ValueError, KeyError):
+                msg.warning(f'Ignoring unreadable manifest {path}')
+
+    @staticmethod
+    def key(pack_path: Path) -> str:
+        return pack_path.resolve().as_posix()
+
+    def get(self, pack_path: Path) -> Optional[dict]:
+        # Previous record of a pack, only if the pack itself has not changed since
+        record = self.packs.get(self.key(pack_path))
+        stat = pack_path.stat()
+        if record is None or record['size'] != stat.st_size or record['mtime_ns'] != stat.st_mtime_ns:
+            return None
+        return record
+
+    def update(self, pack_path: Path, record: dict):
+        self.packs[self.key(pack_path)] = record
+
+    def save(self):
+        temp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(temp_path, 'w') as manifest_f:
+            json.dump({'packs': self.packs}, manifest_f)
+        os.replace(temp_path, self.path)
+
+
+def is_up_to_date(entry: EntryView, output_path: Path, record: Optional[dict]) -> bool:
+    # Whether the output of an entry is still the one written from the same bytes of the same pack
+    if record is None or record['offset'] != entry.offset or record['length'] != entry.length:
+        return False
+    try:
+        stat = (output_path / entry.path).stat()
+    except FileNotFoundError:
+        return False
+    return stat.st_size == record['size'] and stat.st_mtime_ns == record['mtime_ns']
+
+
+# How entries of a new game version are compared with those of the previous one:
+# full hashes the new entry and compares it with the SHA-1 recorded at extraction,
+# sample only compares the bytes of both packs at a few windows and misses changes between them.
+# Entries sample carries over without reading them whole lose their SHA-1, so that no digest of
+# the old content is ever reused for them.
+delta_checks = ['full', 'sample']
+delta_sample_window = 4096
+delta_sample_count = 16
+
+
+def delta_samples(length: int) -> list[tuple[int, int]]:
+    # Ranges relative to the start of an entry that the sample check compares, all of it if it is small
+    if length <= delta_sample_window * delta_sample_count:
+        return [(0, length)]
+    step = (length - delta_sample_window) // (delta_sample_count - 1)
+    return [(i * step, delta_sample_window) for i in range(delta_sample_count)]
+
+
+def carry_over_record(
+        pack_path: Path,
+        table: EntryTable,
+        old_pack_path: Path,
+        old_record: dict,
+        output_path: Path,
+        check: str = 'full',
+        copy_options: CopyOptions = CopyOptions()
+) -> dict:
+    # Manifest record for a pack of a new game version, made of the entries of the previous version
+    # that are still the same: same path, same length, same content, and an output still as extracted.
+    # extract_pack then treats their outputs as up to date and only extracts what the patch changed.
+    old_table = load_pack_index(old_pack_path.with_suffix('.json'))
+    entries: dict[str, dict] = {}
+    with PackReader(pack_path, copy_options) as pack, PackReader(old_pack_path, copy_options) as old_pack:
+        for row in table.by_offset():
+            key = table.path(row)
+            old_row, old_entry = old_table.find(key), old_record['entries'].get(key)
+            offset, length = table.offsets[row], table.lengths[row]
+            if (old_row is None or old_entry is None
+                    or old_table.lengths[old_row] != length
+                    or not is_up_to_date(old_table[old_row], output_path, old_entry)):
+                continue
+            if check == 'sample':
+                old_offset = old_table.offsets[old_row]
+                samples = delta_samples(length)
+                same = True
+                for start, size in samples:
+                    with pack.entry(offset + start, size) as data, old_pack.entry(old_offset + start, size) as old_data:
+                        same = data == old_data
+                    if not same:
+                        break
+                if same:
+                    entries[key] = dict(old_entry, offset=offset)
+                    if samples != [(0, length)]:
+                        entries[key].pop('sha1', None)
+            elif 'sha1' in old_entry:
+                digest = sha1()
+                pack.hash_range(digest, offset, length)
+                if digest.hexdigest() == old_entry['sha1']:
+                    entries[key] = dict(old_entry, offset=offset)
+    return {'entries': entries}
+
+
+def output_record(entry: EntryView, out_f, digest) -> dict:
+    # Manifest record of an output file that has just been written, with the SHA-1 of its content
+    out_f.flush()
+    stat = os.fstat(out_f.fileno())
+    return {
+        'offset': entry.offset,
+        'length': entry.length,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha1': digest.hexdigest(),
+    }
+
+
+def extract_entries(
+        pack_path: Path,
+        output_path: Path,
+        table: EntryTable,
+        run: list[int],
+        copy_options: CopyOptions = CopyOptions()
+) -> tuple[int, int, dict[str, dict]]:
+    # Extract a run of planned rows with a reader of our own,
+    # returns entry and byte counts and the manifest records of the written files
+    if copy_options.pipeline_writers > 0:
+        return extract_entries_pipelined(pack_path, output_path, table, run, copy_options)
+    entries, length = 0, 0
+    records: dict[str, dict] = {}
+    offsets, lengths = table.offsets, table.lengths
+    with PackReader(pack_path, copy_options) as pack:
+        if run:
+            pack.advise_sequential(offsets[run[0]], offsets[run[-1]] + lengths[run[-1]] - offsets[run[0]])
+        for row in run:
+            key = table.path(row)
+            digest = sha1()
+            with open_output(output_path / key) as out_f:
+                pack.io_policy.preallocate(out_f.fileno(), lengths[row])
+                pack.copy_to(out_f, offsets[row], lengths[row], digest)
+                records[key] = output_record(table[row], out_f, digest)
+            entries += 1
+            length += lengths[row]
+    return entries, length, records
+
+
+def extract_entries_pipelined(
+        pack_path: Path,
+        output_path: Path,
+        table: EntryTable,
+        run: list[int],
+        copy_options: CopyOptions
+) -> tuple[int, int, dict[str, dict]]:
+    # Same as extract_entries, but this thread only reads: it fills a bounded pool of chunk buffers
+    # ahead of time while writer threads flush completed chunks to the output files.
+    # Entries are dealt round-robin to the writers, so the chunks of one entry stay in order.
+    chunk_size = copy_options.chunk_size
+    depth = max(copy_options.pipeline_depth, 2)
+    if memory_budget is not None:
+        # The buffers are all allocated up front, so no more of them than the budget holds,
+        # and smaller ones if even two chunks would not fit
+        depth = max(min(depth, memory_budget.limit // chunk_size), 2)
+        chunk_size = max(min(chunk_size, memory_budget.limit // depth), 1)
+    writers = copy_options.pipeline_writers
+    held = memory_budget.acquire(depth * chunk_size) if memory_budget is not None else 0
+    io_policy = io_policies[copy_options.io_policy]
+    free_buffers: queue.Queue = queue.Queue()
+    for _ in range(depth):
+        free_buffers.put(bytearray(chunk_size))
+    work_queues: list[queue.Queue] = [queue.Queue() for _ in range(writers)]
+    writer_results: list[tuple[int, int, dict[str, dict]]] = []
+    errors: list[Exception] = []
+
+    def write(work_queue: queue.Queue):
+        entries, length = 0, 0
+        records: dict[str, dict] = {}
+        out_f = None
+        digest = sha1()
+        while (item := work_queue.get()) is not None:
+            row, buffer, size, first, last = item
+            try:
+                if not errors:
+                    if first:
+                        out_f = open_output(output_path / table.path(row))
+                        io_policy.preallocate(out_f.fileno(), table.lengths[row])
+                        digest = sha1()
+                    with memoryview(buffer if buffer is not None else b'')[:size] as data:
+                        out_f.write(data)
+                        digest.update(data)
+                    if last:
+                        records[table.path(row)] = output_record(table[row], out_f, digest)
                         out_f.close()
-        index_f.close()
-    pack.close()
+                        out_f = None
+                        entries += 1
+                        length += table.lengths[row]
+            except Exception as e:
+                errors.append(e)
+            finally:
+                if buffer is not None:
+                    free_buffers.put(buffer)
+        if out_f is not None:
+            out_f.close()
+        writer_results.append((entries, length, records))
+
+    writer_threads = [Thread(target=write, args=(work_queue,)) for work_queue in work_queues]
+    for writer_thread in writer_threads:
+        writer_thread.start()
+    offsets, lengths = table.offsets, table.lengths
+    try:
+        with PackReader(pack_path, copy_options) as pack:
+            if run:
+                pack.advise_sequential(offsets[run[0]], offsets[run[-1]] + lengths[run[-1]] - offsets[run[0]])
+            for i, row in enumerate(run):
+                if errors:
+                    break
+                work_queue = work_queues[i % writers]
+                offset, length = offsets[row], lengths[row]
+                pack.check(offset, length)
+                if length == 0:
+                    work_queue.put((row, None, 0, True, True))
+                    continue
+                done = 0
+                while done < length:
+                    size = min(chunk_size, length - done)
+                    buffer = free_buffers.get()
+                    try:
+                        pack.read_into(memoryview(buffer)[:size], offset + done)
+                    except Exception:
+                        free_buffers.put(buffer)
+                        raise
+                    work_queue.put((row, buffer, size, done == 0, done + size == length))
+                    done += size
+    finally:
+        for work_queue in work_queues:
+            work_queue.put(None)
+        for writer_thread in writer_threads:
+            writer_thread.join()
+        if memory_budget is not None:
+            memory_budget.release(held)
+    if errors:
+        raise errors[0]
+    return (
+        sum(result[0] for result in writer_results),
+        sum(result[1] for result in writer_results),
+        {key: record for result in writer_results for key, record in result[2].items()}
+    )
+
+
+def extract_pack(
+        pack_path: Path,
+        output_path: Path,
+        threads: int = 1,
+        copy_options: CopyOptions = CopyOptions(),
+        previous: Optional[dict] = None,
+        wanted: Optional[set[str]] = None,
+        verbose: bool = True,
+        baseline: Optional[tuple[Path, dict]] = None,
+        delta_check: str = 'full'
+) -> dict:
+    # Extract every entry of a .pack into output_path that is not up to date according to
+    # the previous manifest record, or only the wanted ones if given.
+    # Without a previous record, the pack and manifest record of the previous game version
+    # in baseline, if any, tell which entries are unchanged and need no extraction.
+    # Entries sharing the Offset and Length of another one are extracted once and linked.
+    # Returns statistics and the new manifest record of the pack.
+    stat = pack_path.stat()
+    record = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'entries': {}}
+    result = {
+        'pack': pack_path.name, 'entries': 0, 'bytes': 0, 'skipped': 0, 'unneeded': 0, 'carried': 0,
+        'aliases': 0, 'alias_bytes': 0, 'links': dict.fromkeys(link_methods, 0), 'manifest': record
+    }
+    if verbose:
+        msg.msg(f'Extracting pack {pack_path.name}...')
+    table = load_pack_index(pack_path.with_suffix('.json'))
+    if previous is None and baseline is not None:
+        previous = carry_over_record(pack_path, table, *baseline, output_path, delta_check, copy_options)
+        result['carried'] = len(previous['entries'])
+
+    # Rows ordered by offset, so that the pack is read in one forward sweep,
+    # and aliases of rows that are up to date or planned, to be linked to their output afterwards
+    plan: list[int] = []
+    aliases: list[tuple[int, int]] = []
+    sources: dict[tuple[int, int], int] = {}
+    previous_entries = previous['entries'] if previous is not None else {}
+    for row in table.by_offset():
+        key = table.path(row)
+        if wanted is not None and key not in wanted:
+            if key in previous_entries:  # Keep what an earlier run extracted
+                record['entries'][key] = previous_entries[key]
+            result['unneeded'] += 1
+            continue
+        span = (table.offsets[row], table.lengths[row])
+        if is_up_to_date(table[row], output_path, previous_entries.get(key)):
+            record['entries'][key] = previous_entries[key]
+            result['skipped'] += 1
+        elif span in sources and span[1] > 0:
+            aliases.append((row, sources[span]))
+            continue
+        else:
+            plan.append(row)
+        sources.setdefault(span, row)
+
+    # Directories of the planned entries, and every group when extracting everything
+    make_directories(chain(
+        (output_path / group for group in (table.groups if wanted is None else [])),
+        ((output_path / table.path(row)).parent for row in chain(plan, (alias for alias, _ in aliases)))
+    ))
+    runs = partition_plan(table, plan, threads)
+    if verbose:
+        msg.msg2(
+            f'Extracting {len(plan)} entries of {len(table.groups)} groups'
+            f' on {max(len(runs), 1)} threads ({result["skipped"]} up to date, {len(aliases)} aliases)...'
+        )
+    with ThreadPoolExecutor(max_workers=max(len(runs), 1)) as executor:
+        for entries, length, records in executor.map(
+                lambda run: extract_entries(pack_path, output_path, table, run, copy_options),
+                runs
+        ):
+            result['entries'] += entries
+            result['bytes'] += length
+            record['entries'].update(records)
+
+    for row, source in aliases:
+        key = table.path(row)
+        result['links'][link_or_copy(output_path / table.path(source), output_path / key)] += 1
+        result['aliases'] += 1
+        result['alias_bytes'] += table.lengths[row]
+        alias_stat = (output_path / key).stat()
+        record['entries'][key] = dict(
+            record['entries'][table.path(source)], size=alias_stat.st_size, mtime_ns=alias_stat.st_mtime_ns
+        )
+    return result
+
+
+def extract_romfs(
+        pack_list: list[Path],
+        output_path: Path,
+        manifest: Manifest,
+        jobs: int = 1,
+        threads: int = 1,
+        copy_options: CopyOptions = CopyOptions(),
+        wanted: Optional[set[str]] = None,
+        baselines: Optional[dict[Path, tuple[Path, dict]]] = None,
+        delta_check: str = 'full'
+) -> tuple[list[dict], list[tuple]]:
+    # Extract packs one by one, or fan them out to a process pool when jobs > 1,
+    # the manifest is updated with every pack extracted successfully.
+    # baselines maps packs to their counterpart of the previous game version and its manifest record.
+    results: list[dict] = []
+    errors: list[tuple[Path, Exception]] = []
+    baselines = baselines if baselines is not None else {}
+    if jobs <= 1:
+        for pack_path in pack_list:
+            try:
+                result = extract_pack(
+                    pack_path, output_path, threads, copy_options, manifest.get(pack_path), wanted,
+                    baseline=baselines.get(pack_path), delta_check=delta_check
+                )
+            except Exception as e:
+                errors.append((pack_path, e))
+                continue
+            manifest.update(pack_path, result['manifest'])
+            results.append(result)
+        return results, errors
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=set_memory_budget, initargs=(memory_budget,)) as executor:
+        futures = {
+            executor.submit(
+                extract_pack, pack_path, output_path, threads, copy_options, manifest.get(pack_path), wanted, False,
+                baselines.get(pack_path), delta_check
+            ): pack_path
+            for pack_path in pack_list
+        }
+        for future in as_completed(futures):
+            pack_path = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                errors.append((pack_path, e))
+                continue
+            msg.msg(
+                f'Extracted pack {pack_path.name} '
+                f'({result["entries"]} entries, {result["aliases"]} aliases, {result["skipped"]} up to date)'
+            )
+            manifest.update(pack_path, result['manifest'])
+            results.append(result)
+    return results, errors
+
+
+# Paths inside the romfs, relative to the extracted romfs root, of everything the conversion reads
+song_list_entry = 'not_audio_or_images/songs/songlist'
+pack_list_entry = 'not_audio_or_images/songs/packlist'
+singles_cover_entry = 'not_large_png/layouts/songselect/folder_singles.png'
+
+
+def original_song_id(song: dict) -> str:
+    return f"dl_{song['id']}" if 'remote_dl' in song and song['remote_dl'] else song['id']
+
+
+def level_identifier(song: dict, controller_alt_chart: bool = False) -> str:
+    return f"{song['set']}.{song['id']}{'.alt' if controller_alt_chart else ''}"
+
+
+def has_controller_alt_chart(diff: dict) -> bool:
+    return 'has_controller_alt_chart' in diff and diff['has_controller_alt_chart']
+
+
+def pack_identifier(pack: dict) -> str:
+    return pack['pack_parent'] if 'pack_parent' in pack else pack['id']
+
+
+def audio_entry(original_id: str) -> str:
+    return f'Fallback/songs/{original_id}/base.ogg'
+
+
+def jacket_entry(original_id: str) -> str:
+    return f'jackets_large/songs/{original_id}/base.jpg'
+
+
+def chart_entry(original_id: str, diff: dict, controller_alt_chart: bool = False) -> str:
+    return f"charts/songs/{original_id}/{diff['ratingClass']}{'c' if controller_alt_chart else ''}.aff"
+
+
+def resolve_background(bg: str, side: int, rating_class: int) -> PurePosixPath:
+    # Background of a chart, it only depends on these three
+    if bg != '':
+        # Song-specific background
+        return PurePosixPath(f'not_audio/img/bg/{bg}.jpg')
+    # Use default background
+    base_background_type = 'byd' if rating_class == 3 else 'base'
+    base_background_name = 'light' if side == 0 else 'conflict'
+    return PurePosixPath(f'not_audio/img/bg/{base_background_type}_{base_background_name}.jpg')
+
+
+def background_entry(song: dict, diff: dict) -> str:
+    return resolve_background(song['bg'], song['side'], diff['ratingClass']).as_posix()
+
+
+def pack_cover_entry(new_id: str) -> str:
+    return f'packs/songs/pack/select_{new_id}.png'
+
+
+def needed_entries(song_list: dict, pack_list: dict) -> set[str]:
+    # Every romfs entry the conversion of these songs and packs will read
+    wanted = {song_list_entry, pack_list_entry}
+    for song in song_list['songs']:
+        original_id = original_song_id(song)
+        wanted.add(audio_entry(original_id))
+        wanted.add(jacket_entry(original_id))
+        for diff in song['difficulties']:
+            wanted.add(chart_entry(original_id, diff))
+            if has_controller_alt_chart(diff):
+                wanted.add(chart_entry(original_id, diff, True))
+            wanted.add(background_entry(song, diff))
+    for pack in pack_list['packs']:
+        new_id = pack_identifier(pack)
+        if new_id != 'single':
+            wanted.add(pack_cover_entry(new_id))
+    return wanted
+
+
+def selected_entries(pack_list: list[Path]) -> Optional[set[str]]:
+    # Entries needed for conversion according to the song list and pack list in the packs,
+    # None if either of them is missing
+    romfs_index = RomfsIndex(pack_list)
+    if song_list_entry not in romfs_index or pack_list_entry not in romfs_index:
+        msg.error('Song list or pack list not found in romfs!')
+        return None
+    wanted = needed_entries(
+        json.loads(romfs_index.read_bytes(song_list_entry)),
+        json.loads(romfs_index.read_bytes(pack_list_entry))
+    )
+    for path in sorted(path for path in wanted if path not in romfs_index):
+        msg.warning(f'{path} is needed but not found in romfs')
+    msg.msg(f'{len(wanted)} of {len(romfs_index)} entries are needed for conversion')
+    return wanted
 
-converted_songs: list[dict] = []
-converted_packs: list[dict] = []
-converted_files: list[dict] = []
-level_identifiers: dict[str, list[str]] = {}
 
-msg.ask('Converting songs...')
+class RomfsIndex:
+    # Where every entry of the romfs lives: the EntryTable of each pack, later packs taking precedence
+    # over earlier ones for paths relative to the extracted romfs root
+    def __init__(self, pack_list: list[Path], cache_path: Optional[Path] = index_cache_path):
+        self.tables = {
+            pack_path: load_pack_index(pack_path.with_suffix('.json'), cache_path) for pack_path in pack_list
+        }
+
+    def __len__(self) -> int:
+        return sum(len(table) for table in self.tables.values())
+
+    def __contains__(self, path: str) -> bool:
+        return self.locate(path) is not None
+
+    def locate(self, path: str) -> Optional[tuple[Path, EntryTable, int]]:
+        for pack_path, table in reversed(self.tables.items()):
+            row = table.find(path)
+            if row is not None:
+                return pack_path, table, row
+        return None
+
+    def paths(self) -> Iterator[str]:
+        for table in self.tables.values():
+            for row in range(len(table)):
+                yield table.path(row)
+
+    def read_bytes(self, path: str) -> bytes:
+        pack_path, table, row = self.locate(path)
+        with PackReader(pack_path) as pack, pack.entry(table.offsets[row], table.lengths[row]) as data:
+            return bytes(data)
+
+
+def tar_header(name: str, size: int, mtime: int, linkname: Optional[str] = None) -> bytes:
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    if linkname is not None:
+        info.type = tarfile.LNKTYPE
+        info.linkname = linkname
+    return info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+
+def write_tar(
+        pack_list: list[Path],
+        out_f,
+        selected: Optional[Callable[[str], bool]] = None,
+        copy_options: CopyOptions = CopyOptions()
+) -> tuple[int, int]:
+    # Stream the entries of the packs, or the selected ones, to out_f as a POSIX tar, straight from the packs.
+    # Headers come from the index lengths and data is copied by PackReader, in the kernel when out_f allows it.
+    # Entries aliasing an earlier one are written as hardlinks to it. Returns entry and byte counts.
+    entries, length, written = 0, 0, 0
+    for pack_path in pack_list:
+        table = load_pack_index(pack_path.with_suffix('.json'))
+        rows = [row for row in table.by_offset() if selected is None or selected(table.path(row))]
+        if not rows:
+            continue
+        mtime = int(pack_path.stat().st_mtime)
+        sources: dict[tuple[int, int], str] = {}
+        with PackReader(pack_path, copy_options) as pack:
+            pack.advise_sequential(
+                table.offsets[rows[0]], table.offsets[rows[-1]] + table.lengths[rows[-1]] - table.offsets[rows[0]]
+            )
+            for row in rows:
+                key, offset, size = table.path(row), table.offsets[row], table.lengths[row]
+                pack.check(offset, size)
+                source = sources.setdefault((offset, size), key) if size > 0 else key
+                if source != key:
+                    header = tar_header(key, 0, mtime, source)
+                    out_f.write(header)
+                    written += len(header)
+                else:
+                    header = tar_header(key, size, mtime)
+                    out_f.write(header)
+                    out_f.flush()  # Kernel-side copies write to the file descriptor, behind the buffer
+                    pack.copy_to(out_f, offset, size)
+                    padding = -size % tarfile.BLOCKSIZE
+                    out_f.write(tarfile.NUL * padding)
+                    written += len(header) + size + padding
+                entries += 1
+                length += size
+    # End of archive, padded to a whole record like tar does
+    end = 2 * tarfile.BLOCKSIZE
+    out_f.write(tarfile.NUL * (end + -(written + end) % tarfile.RECORDSIZE))
+    out_f.flush()
+    return entries, length
+
+
+class DirectoryFS:
+    # Romfs entries read from an extracted romfs directory,
+    # with the manifest records of the extraction to reuse the digests computed back then
+    def __init__(self, root: Path, copy_options: CopyOptions = CopyOptions(), records: Optional[dict] = None):
+        self.root = root
+        self.chunk_size = copy_options.chunk_size
+        self.io_policy = io_policies[copy_options.io_policy]
+        self.records: dict[str, dict] = records if records is not None else {}
+        self.links = dict.fromkeys(link_methods, 0)
+        self.lock = Lock()
+
+    def digest(self, path: str) -> Optional[str]:
+        # SHA-1 recorded at extraction, if the file is still the one written back then
+        record = self.records.get(path)
+        if record is None or 'sha1' not in record:
+            return None
+        try:
+            stat = (self.root / path).stat()
+        except FileNotFoundError:
+            return None
+        if stat.st_size != record['size'] or stat.st_mtime_ns != record['mtime_ns']:
+            return None
+        return record['sha1']
+
+    def read_bytes(self, path: str) -> bytes:
+        return (self.root / path).read_bytes()
+
+    def read_chunks(self, path: str) -> Iterator[memoryview]:
+        with open(self.root / path, 'rb') as in_f:
+            # Most assets are charts and jackets far smaller than a chunk
+            buffer = bytearray(min(self.chunk_size, os.fstat(in_f.fileno()).st_size))
+            self.io_policy.advise_input(in_f.fileno())
+            while count := in_f.readinto(buffer):
+                with memoryview(buffer)[:count] as chunk:
+                    yield chunk
+            self.io_policy.consumed(in_f.fileno())
+
+    def copy(self, path: str, destination: Path) -> str:
+        # Reflink, hardlink or copy an entry to destination, returns the SHA-1 of its content.
+        # A copy is hashed as it is written, a link only if the manifest has no digest for the entry.
+        file_hash = self.digest(path)
+        method = link_file(self.root / path, destination)
+        if method is None:
+            method = 'copy'
+            digest = sha1()
+            with open_output(destination) as out_f:
+                self.io_policy.preallocate(out_f.fileno(), (self.root / path).stat().st_size)
+                for chunk in self.read_chunks(path):
+                    digest.update(chunk)
+                    out_f.write(chunk)
+            file_hash = digest.hexdigest()
+        elif file_hash is None:
+            digest = sha1()
+            for chunk in self.read_chunks(path):
+                digest.update(chunk)
+            file_hash = digest.hexdigest()
+        with self.lock:
+            self.links[method] += 1
+        return file_hash
+
+    def close(self):
+        pass
+
+
+class PackFS:
+    # Romfs entries streamed straight from the packs, without extracting them first
+    def __init__(
+            self,
+            pack_list: list[Path],
+            copy_options: CopyOptions = CopyOptions(),
+            cache_path: Optional[Path] = index_cache_path
+    ):
+        self.copy_options = copy_options
+        self.io_policy = io_policies[copy_options.io_policy]
+        self.index = RomfsIndex(pack_list, cache_path)
+        self.readers: dict[Path, PackReader] = {}
+        self.links = dict.fromkeys(link_methods, 0)
+        self.lock = Lock()
+
+    def locate(self, path: str) -> tuple[PackReader, EntryTable, int]:
+        # Reader of the pack holding path, and the table and row of its entry there
+        location = self.index.locate(path)
+        if location is None:
+            raise FileNotFoundError(f'{path} not found in any pack')
+        pack_path, table, row = location
+        return self.reader(pack_path), table, row
 
-# Convert songs
-level_count = litedb.level_count()
-song_list_path = extracted_romfs_path / 'not_audio_or_images' / 'songs' / 'songlist'
-song_list: dict = json.load(open(song_list_path, 'r'))
+    def reader(self, pack_path: Path) -> PackReader:
+        with self.lock:
+            if pack_path not in self.readers:
+                self.readers[pack_path] = PackReader(pack_path, self.copy_options)
+            return self.readers[pack_path]
 
+    def read_bytes(self, path: str) -> bytes:
+        reader, table, row = self.locate(path)
+        with reader.entry(table.offsets[row], table.lengths[row]) as data:
+            return bytes(data)
 
-def copy_audio(_original_id: str, _song_root_path: Path):
-    audio_root_path = extracted_romfs_path / 'Fallback' / 'songs'
-    shutil.copyfile(  # Copy audio
-        audio_root_path / _original_id / 'base.ogg',
+    def read_chunks(self, path: str) -> Iterator[memoryview]:
+        reader, table, row = self.locate(path)
+        start, size = table.offsets[row], table.lengths[row]
+        for offset in range(start, start + size, reader.chunk_size):
+            length = min(reader.chunk_size, start + size - offset)
+            with reader.entry(offset, length) as chunk:
+                yield chunk
+            reader.release_pages(offset, length)
+
+    def digest(self, path: str) -> Optional[str]:
+        return None
+
+    def copy(self, path: str, destination: Path) -> str:
+        # Copy an entry to destination, returns the SHA-1 of its content.
+        # Entries are not aligned to filesystem blocks within packs, so they cannot be reflinked.
+        reader, table, row = self.locate(path)
+        offset, length = table.offsets[row], table.lengths[row]
+        with self.lock:
+            self.links['copy'] += 1
+        digest = sha1()
+        with open_output(destination) as out_f:
+            reader.io_policy.preallocate(out_f.fileno(), length)
+            reader.copy_to(out_f, offset, length, digest)
+        return digest.hexdigest()
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.readers.clear()
+
+
+class StagedAssets:
+    # Assets copied into final/Level and final/Pack and moved into storage once all are placed,
+    # with the SHA-1 of every copy so that the move does not have to read them again.
+    # Assets of known SHA-1 that an earlier run already put into storage are referenced, not copied.
+    def __init__(self, romfs, storage_root_path: Path):
+        self.romfs = romfs
+        self.storage_root_path = storage_root_path
+        self.placed: dict[Path, str] = {}
+        self.stored: set[Path] = set()
+
+    def copy(self, path: str, destination: Path):
+        file_hash = self.romfs.digest(path)
+        if file_hash is not None and (
+                self.storage_root_path / file_hash[0] / file_hash[1] / f'{file_hash}{destination.suffix}'
+        ).exists():
+            self.stored.add(destination)
+        else:
+            file_hash = self.romfs.copy(path, destination)
+        self.placed[destination] = file_hash
+
+    def finish(self):
+        # Move the copies into storage/<h0>/<h1>/<sha1><suffix>, unless an identical file is already there
+        moved = [(destination, file_hash) for destination, file_hash in self.placed.items()
+                 if destination not in self.stored]
+        make_directories(self.storage_root_path / file_hash[0] / file_hash[1] for _, file_hash in moved)
+        for destination, file_hash in moved:
+            file_hash_path_optimized = (
+                self.storage_root_path / file_hash[0] / file_hash[1] / f'{file_hash}{destination.suffix}'
+            )
+            if not file_hash_path_optimized.exists():
+                destination.rename(file_hash_path_optimized)
+        for type_name in ['Level', 'Pack']:
+            if (final_path / type_name).is_dir():
+                shutil.rmtree(final_path / type_name)
+
+
+class StorageAssets:
+    # Assets written once, straight from the romfs into storage/<h0>/<h1>/<sha1><suffix>,
+    # under the SHA-1 of their would-be paths under final/
+    def __init__(self, romfs, storage_root_path: Path):
+        self.romfs = romfs
+        self.storage_root_path = storage_root_path
+        self.digests: dict[tuple[str, str], str] = {}
+        self.shards: set[Path] = set()
+        self.placed: dict[Path, str] = {}
+
+    def store(self, path: str, suffix: str) -> str:
+        # Put an entry into storage through a temporary file, returns its SHA-1
+        temp_fd, temp_name = mkstemp(suffix='.tmp', dir=self.storage_root_path)
+        os.close(temp_fd)
+        temp_path = Path(temp_name)
+        try:
+            file_hash = self.romfs.copy(path, temp_path)
+            shard_path = self.storage_root_path / file_hash[0] / file_hash[1]
+            if shard_path not in self.shards:
+                shard_path.mkdir(parents=True, exist_ok=True)
+                self.shards.add(shard_path)
+            file_hash_path_optimized = shard_path / f'{file_hash}{suffix}'
+            if file_hash_path_optimized.exists():
+                temp_path.unlink()
+            else:
+                os.replace(temp_path, file_hash_path_optimized)
+        except BaseException:
+            # Leave no partial copy behind in storage
+            temp_path.unlink(missing_ok=True)
+            raise
+        return file_hash
+
+    def copy(self, path: str, destination: Path):
+        suffix = destination.suffix
+        if (path, suffix) not in self.digests:
+            file_hash = self.romfs.digest(path)
+            if file_hash is None or not (self.storage_root_path / file_hash[0] / file_hash[1]
+                                         / f'{file_hash}{suffix}').exists():
+                file_hash = self.store(path, suffix)
+            self.digests[path, suffix] = file_hash
+        self.placed[destination] = self.digests[path, suffix]
+
+    def finish(self):
+        pass
+
+
+def copy_audio(_assets, _original_id: str, _song_root_path: Path):
+    _assets.copy(  # Copy audio
+        audio_entry(_original_id),
         _song_root_path / 'base.ogg'
     )
 
 
-def copy_jacket(_original_id: str, _song_root_path: Path):
-    jacket_root_path = extracted_romfs_path / 'jackets_large' / 'songs'
-    shutil.copyfile(  # Copy jacket
-        jacket_root_path / _original_id / 'base.jpg',
+def copy_jacket(_assets, _original_id: str, _song_root_path: Path):
+    _assets.copy(  # Copy jacket
+        jacket_entry(_original_id),
         _song_root_path / 'base.jpg'
     )
 
 
 def convert_chart(
+        _assets,
         _diff: dict,
         _song: dict,
         _original_id: str,
@@ -185,19 +1441,14 @@ def convert_chart(
         convert_controller_alt_chart_mode: bool = False
 ):
     _background_paths = []
-    background_root_path = extracted_romfs_path / 'not_audio' / 'img' / 'bg'
-    charts_root_path = extracted_romfs_path / 'charts' / 'songs'
     difficulty_names = ['Past', 'Present', 'Future', 'Beyond']
     difficulty_colors = ['#3A6B78FF', '#566947FF', '#482B54FF', '#7C1C30FF']
 
     if not convert_controller_alt_chart_mode:
-        chart_path = charts_root_path / _original_id / f"{_diff['ratingClass']}.aff"
-        if 'has_controller_alt_chart' in _diff and _diff['has_controller_alt_chart']:
-            _has_controller_charts = True
-        else:
-            _has_controller_charts = False
+        chart_path = PurePosixPath(chart_entry(_original_id, _diff))
+        _has_controller_charts = has_controller_alt_chart(_diff)
     else:
-        chart_path = charts_root_path / _original_id / f"{_diff['ratingClass']}c.aff"
+        chart_path = PurePosixPath(chart_entry(_original_id, _diff, True))
         _has_controller_charts = False
 
     _chart: dict = {
@@ -217,8 +1468,8 @@ def convert_chart(
         'DifficultyColor': difficulty_colors[_diff['ratingClass']],
     }
 
-    shutil.copyfile(  # Copy chart
-        chart_path,
+    _assets.copy(  # Copy chart
+        chart_path.as_posix(),
         _song_root_path / chart_path.name
     )
 
@@ -231,61 +1482,47 @@ def convert_chart(
     else:
         _chart['SyncBaseBpm'] = False
         _chart['BpmText'] = _song['bpm'].replace(' ', '').replace('-', ' - ')
-    if _song['bg'] != '':
-        # Song-specific background
-        background_path = background_root_path / f"{song['bg']}.jpg"
-    else:
-        # Use default background
-        base_background_type = 'byd' if _diff['ratingClass'] == 3 else 'base'
-        base_background_name = 'light' if song['side'] == 0 else 'conflict'
-        background_path = background_root_path / f"{base_background_type}_{base_background_name}.jpg"
-    if not (song_root_path / background_path.name).exists():
-        shutil.copyfile(  # Copy background
-            background_path,
-            song_root_path / background_path.name
+    background_path = resolve_background(_song['bg'], _song['side'], _diff['ratingClass'])
+    if not _assets.exists(_song_root_path / background_path.name):
+        _assets.copy(  # Copy background
+            background_path.as_posix(),
+            _song_root_path / background_path.name
         )
         _background_paths.append(background_path)
     _chart['BackgroundPath'] = background_path.name
     return _chart, _background_paths, _has_controller_charts
 
 
-i: int = level_count + 1
-for song in song_list['songs']:
-    msg.msg2(f'Converting song {song["id"]}...')
-    original_id: str = f"dl_{song['id']}" if 'remote_dl' in song and song['remote_dl'] else song['id']
-    new_id: str = f"{song['set']}.{song['id']}"
+def convert_song(_assets, _song: dict, _level_id: int, _alt_level_id: Optional[int] = None) -> list[dict]:
+    # Copy the files of a song and build its level, and its controller alt level if it has an id for one
+    msg.msg2(f'Converting song {_song["id"]}...')
+    original_id: str = original_song_id(_song)
+    new_id: str = level_identifier(_song)
     song_root_path = final_path / 'Level' / new_id
-    song_root_path.mkdir(parents=True, exist_ok=True)
 
-    copy_audio(original_id, song_root_path)
-    copy_jacket(original_id, song_root_path)
+    copy_audio(_assets, original_id, song_root_path)
+    copy_jacket(_assets, original_id, song_root_path)
 
     converted_song: dict = {  # Base information
-        '_id': i,
+        '_id': _level_id,
         'Type': 'Level',
         'Identifier': new_id,
         'IsDefaultAsset': True,
-        'AddedDate': f"d{song['date']}",
+        'AddedDate': f"d{_song['date']}",
         'Version': 0
     }
-    has_controller_charts: bool = False  # need reconvert
     charts: list[dict] = []
-    background_paths: list[Path] = []
-    for diff in song['difficulties']:
-        (
-            chart,
-            background_paths_to_extend,
-            has_controller_charts_to_extend
-        ) = convert_chart(
+    background_paths: list[PurePosixPath] = []
+    for diff in _song['difficulties']:
+        chart, background_paths_to_extend, _ = convert_chart(
+            _assets,
             diff,
-            song,
+            _song,
             original_id,
             song_root_path,
             False
         )
         background_paths.extend(background_paths_to_extend)
-        if has_controller_charts_to_extend:
-            has_controller_charts = True
         charts.append(chart)
     converted_song['Settings'] = {
         'Charts': charts,
@@ -297,130 +1534,564 @@ for song in song_list['songs']:
         *map(lambda x: x.name, background_paths),
         *map(lambda x: x['ChartPath'], charts),
     ]
-    converted_songs.append(converted_song)
-    if song['set'] not in level_identifiers:
-        level_identifiers[song['set']] = []
-    level_identifiers[song['set']].append(new_id)
-    i += 1
-
-    if has_controller_charts:
-        converted_song_alt: dict = deepcopy(converted_song)
-        alt_new_id: str = f"{song['set']}.{song['id']}.alt"
-        song_root_path = final_path / 'Level' / alt_new_id
-        song_root_path.mkdir(parents=True, exist_ok=True)
-        copy_audio(original_id, song_root_path)
-        copy_jacket(original_id, song_root_path)
-        converted_song_alt['_id'] = i
-        converted_song_alt['Identifier'] = alt_new_id
-
-        alt_charts: list[dict] = []
-        for diff in song['difficulties']:
-            if 'has_controller_alt_chart' in diff and diff['has_controller_alt_chart']:
-                chart, _, _ = convert_chart(
-                    diff,
-                    song,
-                    original_id,
-                    song_root_path,
-                    True
-                )
-                alt_charts.append(chart)
-        converted_song_alt['Settings'] = {
-            'Charts': alt_charts,
-            'LastOpenedChartPath': alt_charts[-1]['ChartPath'],
+    if _alt_level_id is None:
+        return [converted_song]
+
+    converted_song_alt: dict = deepcopy(converted_song)
+    alt_new_id: str = level_identifier(_song, True)
+    song_root_path = final_path / 'Level' / alt_new_id
+    copy_audio(_assets, original_id, song_root_path)
+    copy_jacket(_assets, original_id, song_root_path)
+    converted_song_alt['_id'] = _alt_level_id
+    converted_song_alt['Identifier'] = alt_new_id
+
+    alt_charts: list[dict] = []
+    for diff in _song['difficulties']:
+        if has_controller_alt_chart(diff):
+            chart, _, _ = convert_chart(
+                _assets,
+                diff,
+                _song,
+                original_id,
+                song_root_path,
+                True
+            )
+            alt_charts.append(chart)
+    converted_song_alt['Settings'] = {
+        'Charts': alt_charts,
+        'LastOpenedChartPath': alt_charts[-1]['ChartPath'],
+    }
+    converted_song['FileReferences'] = [
+        'base.ogg',
+        'base.jpg',
+        *map(lambda x: x.name, background_paths),
+        *map(lambda x: x['ChartPath'], alt_charts),
+    ]
+    return [converted_song, converted_song_alt]
+
+
+class PlaceAsset(NamedTuple):
+    source: str  # Path inside the romfs
+    destination: Path  # Path under final/, the name the asset is referenced by
+
+
+class AddDocument(NamedTuple):
+    subcommand: str  # AddLevel or AddPack
+    document: dict
+
+
+class ReferenceFile(NamedTuple):
+    destination: Path  # Path under final/ to add a FileReference row for
+    blob: Path  # Destination of the placement it shares the SHA-1 of, itself unless the source was placed already
+
+
+class ConversionPlan:
+    # Everything a conversion does, decided without touching a single file: assets to place,
+    # then documents and FileReference rows to add to the database, in this order.
+    # Songs and packs are converted with the plan standing in for the asset sink.
+    # An entry is placed once per suffix, later destinations of it, such as the audio and jacket
+    # of alt levels, refer to the same blob in storage without being copied or hashed again.
+    # A destination is planned once, packs sharing a pack_parent all copy the same cover to it.
+    def __init__(self):
+        self.placements: list[PlaceAsset] = []
+        self.documents: list[AddDocument] = []
+        self.references: list[ReferenceFile] = []
+        self.destinations: set[Path] = set()
+        self.blobs: dict[tuple[str, str], Path] = {}
+
+    def copy(self, path: str, destination: Path):
+        if destination in self.destinations:
+            return
+        blob = self.blobs.setdefault((path, destination.suffix), destination)
+        if blob == destination:
+            self.placements.append(PlaceAsset(path, destination))
+        self.references.append(ReferenceFile(destination, blob))
+        self.destinations.add(destination)
+
+    def exists(self, destination: Path) -> bool:
+        return destination in self.destinations
+
+    def operations(self) -> list:
+        return [*self.placements, *self.documents, *self.references]
+
+
+def plan_conversion(song_list: dict, pack_list: dict, level_count: int, pack_count: int) -> ConversionPlan:
+    plan = ConversionPlan()
+    level_identifiers: dict[str, list[str]] = {}
+
+    # Convert songs
+    i: int = level_count + 1
+    for song in song_list['songs']:
+        level_identifiers.setdefault(song['set'], []).append(level_identifier(song))
+        alt_level_id: Optional[int] = None
+        if any(has_controller_alt_chart(diff) for diff in song['difficulties']):
+            alt_level_id = i + 1
+            level_identifiers[song['set']].append(level_identifier(song, True))
+        for level in convert_song(plan, song, i, alt_level_id):
+            plan.documents.append(AddDocument('AddLevel', level))
+        i += 1 if alt_level_id is None else 2
+    backgrounds = sum(1 for path, _ in plan.blobs if path.startswith('not_audio/img/bg/'))
+    msg.msg(f'{backgrounds} distinct backgrounds, each placed once')
+
+    msg.ask('Converting packs...')
+
+    # Convert packs
+    singles_cover_path = PurePosixPath(singles_cover_entry)
+    i: int = pack_count + 1
+    for pack in pack_list['packs']:
+        msg.msg2(f'Converting pack {pack["id"]}...')
+        new_id: str = pack_identifier(pack)
+        pack_root_path = final_path / 'Pack' / new_id
+        pack_cover_path = PurePosixPath(pack_cover_entry(new_id))
+        if new_id == 'single':  # Copy cover (Memory Archive)
+            pack_cover_path = singles_cover_path
+        else:
+            plan.copy(  # Copy cover (Pack)
+                pack_cover_path.as_posix(),
+                pack_root_path / pack_cover_path.name
+            )
+        converted_pack: dict = {
+            '_id': i,
+            'Type': 'Pack',
+            'PackName': pack['name_localized']['en'],
+            'ImagePath': pack_cover_path.name,
+            'LevelIdentifiers': level_identifiers[pack['id']],
+            'Identifier': new_id,
+            'Version': 0,
+            'FileReferences': [pack_cover_path.name],
+            'AddedDate': f"d{int(time())}",
+            "IsDefaultAsset": True,
         }
-        converted_song['FileReferences'] = [
-            'base.ogg',
-            'base.jpg',
-            *map(lambda x: x.name, background_paths),
-            *map(lambda x: x['ChartPath'], alt_charts),
-        ]
-        level_identifiers[song['set']].append(alt_new_id)
-        converted_songs.append(converted_song_alt)
+        plan.documents.append(AddDocument('AddPack', converted_pack))
         i += 1
+    return plan
 
-msg.ask('Converting packs...')
-
-# Convert packs
-pack_count = litedb.pack_count()
-pack_list_path = extracted_romfs_path / 'not_audio_or_images' / 'songs' / 'packlist'
-pack_list: dict = json.load(open(pack_list_path, 'r'))
-pack_cover_root_path = extracted_romfs_path / 'packs' / 'songs' / 'pack'
-singles_cover_path = extracted_romfs_path / 'not_large_png' / 'layouts' / 'songselect' / 'folder_singles.png'
-i: int = pack_count + 1
-
-for pack in pack_list['packs']:
-    msg.msg2(f'Converting pack {pack["id"]}...')
-    new_id: str = pack['pack_parent'] if 'pack_parent' in pack else pack['id']
-    pack_root_path = final_path / 'Pack' / new_id
-    pack_root_path.mkdir(parents=True, exist_ok=True)
-    pack_cover_path = pack_cover_root_path / f"select_{new_id}.png"
-    if new_id == 'single':  # Copy cover (Memory Archive)
-        pack_cover_path = singles_cover_path
-    else:
-        shutil.copyfile(  # Copy cover (Pack)
-            pack_cover_path,
-            pack_root_path / pack_cover_path.name
-        )
-    converted_pack: dict = {
-        '_id': i,
-        'Type': 'Pack',
-        'PackName': pack['name_localized']['en'],
-        'ImagePath': pack_cover_path.name,
-        'LevelIdentifiers': level_identifiers[pack['id']],
-        'Identifier': new_id,
-        'Version': 0,
-        'FileReferences': [pack_cover_path.name],
-        'AddedDate': f"d{int(time())}",
-        "IsDefaultAsset": True,
-    }
-    converted_packs.append(converted_pack)
-    i += 1
 
-msg.ask('Moving files...')
+def print_plan(plan: ConversionPlan, out_f):
+    # One JSON object per operation
+    for operation in plan.operations():
+        print(json.dumps({
+            'op': type(operation).__name__,
+            **{key: value.as_posix() if isinstance(value, Path) else value for key, value in operation._asdict().items()}
+        }), file=out_f)
 
-# exit(0)
 
-# Move files
-storage_root_path = final_path / 'storage'
-storage_root_path.mkdir(parents=True, exist_ok=True)
+def execute_plan(plan: ConversionPlan, assets, litedb: LiteDB, workers: int = 1, batch_size: int = 64):
+    msg.ask('Placing files...')
 
-for type_name in ['Level', 'Pack']:
-    for file in (final_path / type_name).glob('**/*'):
-        if file.is_file():
-            file_real_path: str = file.relative_to(final_path).as_posix()
-            file_hash: str = sha1(open(file, 'rb').read()).hexdigest()
-            file_hash_path = storage_root_path / f"{file_hash}{file.suffix}"
-            file_hash_path_optimized = storage_root_path / file_hash[0] / file_hash[1] / f"{file_hash}{file.suffix}"
-            file_hash_path_optimized.parent.mkdir(parents=True, exist_ok=True)
-            if not file_hash_path_optimized.exists():
-                file.rename(file_hash_path_optimized)
-            converted_files.append({
-                '_id': file_real_path,
-                'RealPath': file_hash_path.name,
-                'CorrectHashPath': file_hash_path.name,
+    # Placements are independent of each other, they are handed to the worker threads in batches
+    batches = [plan.placements[i:i + batch_size] for i in range(0, len(plan.placements), max(batch_size, 1))]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(lambda batch: [assets.copy(*placement) for placement in batch], batches):
+            pass
+    links = assets.romfs.links
+    msg.msg(
+        f'Placed {len(plan.placements)} files for {len(plan.references)} file references'
+        + (', new ones by ' + ', '.join(f'{method} ({count})' for method, count in links.items() if count)
+           if any(links.values()) else '')
+    )
+
+    msg.ask('Moving files...')
+    assets.finish()
+
+    msg.ask('Updating database...')
+    inserting = {'AddLevel': 'songs', 'AddPack': 'packs', 'AddFile': 'files'}
+    subcommand = None
+    for operation in [*plan.documents, *plan.references]:
+        if isinstance(operation, ReferenceFile):
+            file_hash_path_name = f'{assets.placed[operation.blob]}{operation.destination.suffix}'
+            name, content = 'AddFile', json.dumps({
+                '_id': operation.destination.relative_to(final_path).as_posix(),
+                'RealPath': file_hash_path_name,
+                'CorrectHashPath': file_hash_path_name,
             })
-    shutil.rmtree(final_path / type_name)
+        else:
+            name, content = operation.subcommand, re.sub(r'"(d\d+)"', r'\1', json.dumps(operation.document))
+        if name != subcommand:
+            msg.msg(f'Inserting {inserting[name]}...')
+            subcommand = name
+        litedb.subcommand(name, content)
+
 
-msg.ask("Updating database...")
+def parse_size(text: str) -> int:
+    # Sizes such as 4096, 512K, 8M or 1G
+    match = re.fullmatch(r'(\d+)([KMG]?)(?:i?B)?', text.strip(), re.IGNORECASE)
+    if match is None:
+        raise argparse.ArgumentTypeError(f'invalid size: {text}')
+    return int(match[1]) << {'': 0, 'K': 10, 'M': 20, 'G': 30}[match[2].upper()]
 
-# Update database
-msg.msg('Inserting songs...')
-for song in converted_songs:
-    litedb.subcommand(
-        'AddLevel',
-        re.sub(r'"(d\d+)"', r'\1', json.dumps(song))
+
+commands = ['convert', 'extract', 'validate']
+
+
+def parse_args(argv: list[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Chart unpacker for certain rhythm game.',
+        epilog='Without a command, the arguments are those of convert.'
+    )
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+
+    validate_parser = subparsers.add_parser('validate', help='check the pack indexes of a romfs before extracting it')
+    validate_parser.add_argument('romfs', type=Path, help='path to the dumped romfs')
+
+    # Arguments of the extraction, shared by extract and convert
+    extraction_parser = argparse.ArgumentParser(add_help=False)
+    extraction_parser.add_argument('romfs', type=Path, help='path to the dumped romfs')
+    extraction_parser.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help='number of packs to extract in parallel, 0 for one per CPU (default: 1)'
+    )
+    extraction_parser.add_argument(
+        '-t', '--threads', type=int, default=1,
+        help='number of threads extracting each pack, split into ranges of equal size (default: 1)'
+    )
+    extraction_parser.add_argument(
+        '--copy-backend', choices=copy_backends, default=default_copy_backend(),
+        help='how entries are copied out of packs, falls back to the next one on failure '
+             f'(default: {default_copy_backend()})'
+    )
+    extraction_parser.add_argument(
+        '-f', '--force', action='store_true',
+        help='extract every entry again, even those the manifest reports as up to date'
+    )
+    extraction_parser.add_argument(
+        '-s', '--selective', action='store_true',
+        help='only extract the entries the conversion reads, worked out from the song list and pack list'
     )
-msg.msg('Inserting packs...')
-for pack in converted_packs:
-    litedb.subcommand(
-        'AddPack',
-        re.sub(r'"(d\d+)"', r'\1', json.dumps(pack))
+    extraction_parser.add_argument(
+        '--previous', type=Path, metavar='OLD_ROMFS',
+        help='romfs of the previous game version extracted here before, '
+             'only entries changed since then are extracted'
     )
-msg.msg('Inserting files...')
-for file in converted_files:
-    litedb.subcommand(
-        'AddFile',
-        json.dumps(file)
+    extraction_parser.add_argument(
+        '--delta-check', choices=delta_checks, default='full',
+        help='how entries are compared with the previous version: full hashes every entry, sample only '
+             'compares both packs at a few places and can miss a change between them (default: full)'
     )
+    extraction_parser.add_argument(
+        '--chunk-size', type=parse_size, default=CopyOptions().chunk_size,
+        help='largest piece of an entry copied at once (default: 8M)'
+    )
+    extraction_parser.add_argument(
+        '--memory-budget', type=parse_size, default=256 << 20,
+        help='entry data all extraction workers may hold in memory together, 0 for no limit (default: 256M)'
+    )
+    extraction_parser.add_argument(
+        '--pipeline', type=int, default=0, metavar='WRITERS',
+        help='read entries ahead on one thread and write them out on WRITERS threads, '
+             'useful when the pack and the output are on different devices (default: 0, off)'
+    )
+    extraction_parser.add_argument(
+        '--prefetch', type=int, default=CopyOptions().pipeline_depth, metavar='CHUNKS',
+        help=f'chunk buffers the pipeline may read ahead (default: {CopyOptions().pipeline_depth})'
+    )
+    extraction_parser.add_argument(
+        '--io-policy', choices=list(io_policies), default='default',
+        help='page cache use: streaming evicts what has been read and suits shared hosts, '
+             'aggressive reads packs ahead and keeps everything cached (default: default)'
+    )
+
+    extract_parser = subparsers.add_parser(
+        'extract', parents=[extraction_parser], help='extract a romfs without converting it'
+    )
+    extract_parser.add_argument(
+        '--to-tar', type=Path, metavar='FILE',
+        help='write the entries as a tar archive to FILE, - for stdout, instead of into extracted_romfs'
+    )
+    extract_parser.add_argument(
+        '-i', '--include', action='append', metavar='PATTERN',
+        help='only extract entries whose path matches PATTERN, can be given more than once'
+    )
+
+    convert_parser = subparsers.add_parser(
+        'convert', parents=[extraction_parser], help='extract a romfs and convert it into a litedb (default)'
+    )
+    convert_parser.add_argument('litedb', type=Path, help='path to the arccreate.litedb file')
+    convert_parser.add_argument(
+        '-w', '--workers', type=int, default=1,
+        help='number of threads placing assets in parallel, 0 for one per CPU (default: 1)'
+    )
+    convert_parser.add_argument(
+        '--batch-size', type=int, default=64, metavar='FILES',
+        help='assets handed to a worker thread at a time (default: 64)'
+    )
+    convert_parser.add_argument(
+        '-n', '--dry-run', action='store_true',
+        help='print the conversion plan as JSON lines without extracting, copying or inserting anything'
+    )
+    convert_parser.add_argument(
+        '--from-packs', action='store_true',
+        help='read assets straight from the packs instead of extracting the romfs first'
+    )
+    convert_parser.add_argument(
+        '--direct-storage', action='store_true',
+        help='write each asset once, straight into final/storage, instead of staging it under final/Level and final/Pack'
+    )
+    if not argv or argv[0] not in [*commands, '-h', '--help']:
+        argv = ['convert', *argv]
+    args = parser.parse_args(argv)
+    if args.command in ['convert', 'extract']:
+        if args.jobs <= 0:
+            args.jobs = os.cpu_count() or 1
+        args.threads = max(args.threads, 1)
+    if args.command == 'convert' and args.workers <= 0:
+        args.workers = os.cpu_count() or 1
+    return args
+
+
+def extraction_options(args: argparse.Namespace) -> CopyOptions:
+    # Copy options of the extraction arguments, the memory budget of this process is set on the way
+    set_memory_budget(MemoryBudget(args.memory_budget, args.jobs > 1) if args.memory_budget > 0 else None)
+    return CopyOptions(args.copy_backend, args.chunk_size, args.pipeline, args.prefetch, args.io_policy)
+
+
+def extract_to_directory(
+        args: argparse.Namespace,
+        pack_list: list[Path],
+        copy_options: CopyOptions,
+        wanted: Optional[set[str]] = None
+) -> tuple[Manifest, bool]:
+    # Extract the packs, or the wanted entries of them, into extracted_romfs as the extraction arguments say,
+    # returns the updated manifest and whether every pack was extracted
+    extracted_romfs_path.mkdir(parents=True, exist_ok=True)
+    manifest = Manifest(extracted_romfs_path / '.manifest.json')
+    if args.force:
+        manifest.packs.clear()
+
+    # Packs of the previous game version that were extracted here, to carry their unchanged entries over
+    baselines: dict[Path, tuple[Path, dict]] = {}
+    if args.previous is not None:
+        for pack_path in pack_list:
+            old_pack_path = args.previous / pack_path.name
+            if Manifest.key(old_pack_path) == Manifest.key(pack_path) or not old_pack_path.exists():
+                continue
+            old_record = manifest.get(old_pack_path)
+            if old_record is not None:
+                baselines[pack_path] = (old_pack_path, old_record)
+            else:
+                msg.warning(f'{old_pack_path} was not extracted here, extracting {pack_path.name} in full')
+
+    results, errors = extract_romfs(
+        pack_list, extracted_romfs_path, manifest, args.jobs, args.threads, copy_options, wanted,
+        baselines, args.delta_check
+    )
+    for pack_path, (old_pack_path, _) in baselines.items():  # Superseded by the new version
+        if manifest.packs.get(Manifest.key(pack_path)) is not None:
+            manifest.packs.pop(Manifest.key(old_pack_path), None)
+    manifest.save()
+    msg.msg(
+        f'Extracted {sum(r["entries"] for r in results)} entries '
+        f'({sum(r["bytes"] for r in results)} bytes) from {len(results)} packs, '
+        f'{sum(r["skipped"] for r in results)} entries up to date, '
+        f'{sum(r["unneeded"] for r in results)} not needed'
+    )
+    if baselines:
+        msg.msg2(
+            f'{sum(r["carried"] for r in results)} entries unchanged since {args.previous}, '
+            f'compared by {args.delta_check} check'
+        )
+    if any(r['aliases'] for r in results):
+        links = {method: sum(r['links'][method] for r in results) for method in link_methods}
+        msg.msg2(
+            f'Linked {sum(r["aliases"] for r in results)} aliased entries '
+            f'({sum(r["alias_bytes"] for r in results)} bytes) instead of extracting them: '
+            + ', '.join(f'{count} by {method}' for method, count in links.items() if count)
+        )
+    for pack_path, error in errors:
+        msg.error(f'Failed to extract pack {pack_path.name}: {error}')
+    return manifest, not errors
+
+
+def validate(args: argparse.Namespace) -> int:
+    # Check every pack index of the romfs without extracting or caching anything, returns the exit status
+    msg.ask('Validating romfs...')
+    if not args.romfs.exists():
+        msg.error('Input romfs not found!')
+        return 1
+    start = time()
+    tables: dict[Path, EntryTable] = {
+        pack_path: load_pack_index(pack_path.with_suffix('.json'), None)
+        for pack_path in sorted(args.romfs.glob('*.pack'))
+    }
+    failed = False
+    pack_of_path: dict[str, Path] = {}
+    for pack_path, table in tables.items():
+        pack_size = pack_path.stat().st_size
+        problems = check_pack_index(table, pack_size)
+        msg.msg(
+            f'{pack_path.name}: {len(table)} entries, {problems.aliases} aliases, '
+            f'{problems.gap_bytes} of {pack_size} bytes not covered by any entry'
+        )
+        reports = [
+            *(f'{table.path(row)} ends at {table.offsets[row] + table.lengths[row]}, past the end of the pack'
+              for row in problems.out_of_bounds),
+            *(f'{table.path(row)} overlaps {table.path(other)}' for row, other in problems.overlaps),
+            *(f'{table.path(row)} appears more than once' for row in problems.duplicates),
+        ]
+        for report in reports[:20]:
+            msg.error(f'{pack_path.name}: {report}')
+        if len(reports) > 20:
+            msg.error(f'{pack_path.name}: ... and {len(reports) - 20} more problems')
+        for row in problems.empty[:20]:
+            msg.warning(f'{pack_path.name}: {table.path(row)} is empty')
+        failed = failed or bool(reports)
+
+        # Paths shipped by more than one pack
+        for path in {table.path(row) for row in range(len(table))}:
+            if path in pack_of_path:
+                msg.error(f'{path} is in both {pack_of_path[path].name} and {pack_path.name}')
+                failed = True
+            pack_of_path[path] = pack_path
+    msg.msg(
+        f'Checked {len(pack_of_path)} paths of {len(tables)} packs in {time() - start:.3f}s'
+        f'{"" if numpy is not None else " (install NumPy for faster checks)"}'
+    )
+    return 1 if failed else 0
+
+
+def extract(args: argparse.Namespace) -> int:
+    # Extract the romfs, or the selected part of it, into extracted_romfs or a tar stream, returns the exit status
+    if not args.romfs.exists():
+        msg.error('Input romfs not found!')
+        return 1
+    pack_list = sorted(args.romfs.glob('*.pack'))
+    copy_options = extraction_options(args)
+
+    # Messages go to stderr while the archive goes to stdout
+    to_stdout = args.to_tar is not None and args.to_tar.as_posix() == '-'
+    with redirect_stdout(sys.stderr if to_stdout else sys.stdout):
+        wanted: Optional[set[str]] = None
+        if args.selective and pack_list:
+            wanted = selected_entries(pack_list)
+            if wanted is None:
+                return 1
+        if wanted is None and not args.include:
+            selected = None
+        else:
+            def selected(path: str) -> bool:
+                return (wanted is None or path in wanted) and (
+                    not args.include or any(fnmatch.fnmatchcase(path, pattern) for pattern in args.include)
+                )
+
+        if args.to_tar is not None:
+            msg.ask(f'Writing romfs to {"stdout" if to_stdout else args.to_tar} as tar...')
+            start = time()
+            if to_stdout:
+                entries, length = write_tar(pack_list, sys.__stdout__.buffer, selected, copy_options)
+            else:
+                with open(args.to_tar, 'wb') as out_f:
+                    entries, length = write_tar(pack_list, out_f, selected, copy_options)
+            msg.msg(f'Wrote {entries} entries ({length} bytes) in {time() - start:.3f}s')
+            return 0
+
+        msg.ask('Extracting romfs...')
+        if args.include:
+            wanted = {path for path in RomfsIndex(pack_list).paths() if selected(path)}
+        _, extracted = extract_to_directory(args, pack_list, copy_options, wanted)
+        return 0 if extracted else 1
+
+
+def convert(args: argparse.Namespace):
+    msg.ask('Preparing ...')
+
+    # Check for required files
+    if not litedb_path.exists():
+        msg.error('ArcUnpack.LiteDB not found!')
+        sys.exit(1)
+
+    if not args.romfs.exists():
+        if extracted_romfs_path.exists() and not args.from_packs:
+            msg.warning('Extracted romfs found, skipping extraction...')
+        else:
+            msg.error('Input romfs not found!')
+            sys.exit(1)
+
+    # Make folders
+    if not args.from_packs and not args.dry_run:
+        extracted_romfs_path.mkdir(parents=True, exist_ok=True)
+    if not args.dry_run:
+        final_path.mkdir(parents=True, exist_ok=True)
+
+    # Copy database file
+    arc_create_db_path = final_path / 'arccreate.litedb'
+    if not arc_create_db_path.exists() and not args.dry_run:
+        shutil.copy(args.litedb, arc_create_db_path)
+
+    # LiteDB instance, a dry run only reads the counts from it
+    litedb = LiteDB(arc_create_db_path if arc_create_db_path.exists() else args.litedb)
+
+    copy_options = extraction_options(args)
+
+    # File list to extract
+    pack_list: list[Path] = []
+    for pack_path in args.romfs.glob('*.pack'):
+        pack_list.append(pack_path)
+    pack_list.sort()
+
+    if args.from_packs or (args.dry_run and pack_list):
+        # Read assets straight from the packs, a dry run does not even write the index cache
+        romfs = PackFS(pack_list, copy_options, None if args.dry_run else index_cache_path)
+    elif args.dry_run:
+        # Nothing to extract, plan from what an earlier run extracted
+        romfs = DirectoryFS(extracted_romfs_path, copy_options)
+    else:
+        msg.ask('Extracting romfs...')
+
+        # Extract romfs
+        wanted: Optional[set[str]] = None
+        if args.selective and pack_list:
+            wanted = selected_entries(pack_list)
+            if wanted is None:
+                sys.exit(1)
+
+        manifest, extracted = extract_to_directory(args, pack_list, copy_options, wanted)
+        if not extracted:
+            sys.exit(1)
+        romfs = DirectoryFS(
+            extracted_romfs_path,
+            copy_options,
+            {key: record for pack in manifest.packs.values() for key, record in pack['entries'].items()}
+        )
+
+    msg.ask('Converting songs...')
+
+    # Plan the conversion
+    song_list: dict = json.loads(romfs.read_bytes(song_list_entry))
+    pack_list: dict = json.loads(romfs.read_bytes(pack_list_entry))
+    plan = plan_conversion(song_list, pack_list, litedb.level_count(), litedb.pack_count())
+    if args.dry_run:
+        romfs.close()
+        print_plan(plan, sys.__stdout__)
+        msg.msg(
+            f'Planned {len(plan.placements)} files, {len(plan.references)} file references and '
+            f'{len(plan.documents)} documents, nothing was extracted, copied or inserted'
+        )
+        return
+
+    # Execute it
+    storage_root_path = final_path / 'storage'
+    if args.direct_storage:
+        storage_root_path.mkdir(parents=True, exist_ok=True)
+        assets = StorageAssets(romfs, storage_root_path)
+    else:
+        make_directories(placement.destination.parent for placement in plan.placements)
+        assets = StagedAssets(romfs, storage_root_path)
+    execute_plan(plan, assets, litedb, args.workers, args.batch_size)
+    romfs.close()
+
+    msg.ask('Done!')
+
+
+def main(argv: list[str]):
+    args = parse_args(argv)
+    if args.command == 'validate':
+        sys.exit(validate(args))
+    if args.command == 'extract':
+        sys.exit(extract(args))
+    # A dry run prints the plan on stdout, so messages go to stderr
+    with redirect_stdout(sys.stderr if args.dry_run else sys.stdout):
+        convert(args)
+
 
-msg.ask('Done!')
+if __name__ == '__main__':
+    main(sys.argv[1:])